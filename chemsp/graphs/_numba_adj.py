@@ -0,0 +1,83 @@
+"""
+Numba backend for the adjacency computation. Imported lazily by graph_operators.adjacency so that numba remains an
+optional dependency.
+
+Functions
+=========
+
+pairwise : Computes the symmetric adjacency matrix for a jitted metric, evaluating only the upper triangle in parallel.
+rbf : Returns a jitted radial basis function kernel with a given length scale.
+euclidean : Jitted euclidean distance between two vectors.
+tanimoto : Jitted (continuous) Tanimoto similarity between two vectors.
+"""
+import numpy as np
+from numba import njit, prange
+
+@njit(parallel=True, fastmath=True)
+def _pairwise(X, out, metric):
+    M = X.shape[0]
+    for i in prange(M):
+        for j in range(i, M):
+            out[i,j] = metric(X[i], X[j])
+            out[j,i] = out[i,j]
+
+def pairwise(X, metric):
+    """
+    Computes the adjacency matrix of X using a numba jitted metric. The metric is assumed to be symmetric so only the
+    upper triangle is evaluated, with the outer loop parallelised across cores.
+
+    Parameters
+    ----------
+    X : np.array(NxM)
+        An array containing N molecules with their associated M dimensional representation
+
+    metric : numba.core.registry.CPUDispatcher
+        A function decorated with numba.njit that operates on two vectors to compute their similarity/distance
+    """
+    X = np.ascontiguousarray(X, dtype=np.float64)
+    out = np.empty((X.shape[0], X.shape[0]))
+    _pairwise(X, out, metric)
+    return out
+
+@njit(fastmath=True)
+def euclidean(x, y):
+    d = 0.0
+    for k in range(x.shape[0]):
+        d += (x[k] - y[k])**2
+    return np.sqrt(d)
+
+@njit(fastmath=True)
+def tanimoto(x, y):
+    xy = 0.0
+    xx = 0.0
+    yy = 0.0
+    for k in range(x.shape[0]):
+        xy += x[k] * y[k]
+        xx += x[k] * x[k]
+        yy += y[k] * y[k]
+    denom = xx + yy - xy
+    if denom == 0.0:
+        return 1.0
+    return xy / denom
+
+def rbf(length_scale=1.0):
+    """
+    Returns a jitted radial basis function kernel, exp(-||x-y||^2 / (2 * length_scale^2)).
+
+    Parameters
+    ----------
+    length_scale : float, default=1.0
+        The length scale of the kernel.
+    """
+    gamma = 1 / (2 * length_scale**2)
+    @njit(fastmath=True)
+    def _rbf(x, y):
+        d = 0.0
+        for k in range(x.shape[0]):
+            d += (x[k] - y[k])**2
+        return np.exp(-gamma * d)
+    return _rbf
+
+metrics = {"euclidean" : euclidean,
+           "tanimoto"  : tanimoto,
+           "rbf"       : rbf()}
@@ -4,14 +4,62 @@ Implements the necessary code to generate a variety of different graph shift ope
 Functions
 =========
 
-adj: Computes an adjacency matrix given a metric and a list of X values
-lap: Computes a graph Laplacian matrix from an adjacency matrix.
+adjacency: Computes an adjacency matrix given a metric and a list of X values
+degree: Computes the degree matrix from an adjacency matrix.
+laplacian: Computes a graph Laplacian matrix from an adjacency matrix.
 """
 import numpy as np
+from scipy.spatial.distance import cdist, pdist, squareform
 
-def adjacency(X,metric):
+try:
+    from sklearn.gaussian_process.kernels import RBF
+    from sklearn.metrics.pairwise import rbf_kernel
+except ImportError:
+    RBF = None
+
+def _squared_distances(X):
+    """
+    Computes the matrix of squared euclidean distances with the expansion ||x-y||^2 = ||x||^2 + ||y||^2 - 2<x,y>, so that
+    all of the work is a single GEMM.
+    """
+    sq = np.einsum("ij,ij->i",X,X)
+    D = X @ X.T
+    D *= -2
+    D += sq[:,None]
+    D += sq[None,:]
+    return np.maximum(D,0,out=D) # Clip the small negative values introduced by cancellation.
+
+def _row_chunk(X,metric,rows,symmetric):
+    """
+    Evaluates the metric between each of the given rows of X and the rest of X (only the upper triangle if symmetric).
+    """
+    return [[metric(X[i],X[j]) for j in range(i if symmetric else 0,len(X))] for i in rows]
+
+def _parallel_pairwise(X,metric,n_jobs,symmetric):
+    """
+    Splits the rows of the adjacency matrix into chunks that are dynamically scheduled over joblib workers.
+    """
+    from joblib import Parallel, delayed, effective_n_jobs
+    N = len(X)
+    chunks = np.array_split(np.arange(N),min(N,4*effective_n_jobs(n_jobs)))
+    results = Parallel(n_jobs=n_jobs)(delayed(_row_chunk)(X,metric,chunk,symmetric) for chunk in chunks)
+    adj = np.empty((N,N))
+    for chunk, rows in zip(chunks,results):
+        for i, row in zip(chunk,rows):
+            adj[i,N-len(row):] = row
+    if symmetric:
+        i, j = np.triu_indices(N,1)
+        adj[j,i] = adj[i,j]
+    return adj
+
+def adjacency(X,metric,symmetric=False,backend=None,radial=False,n_jobs=None):
     """
     Computes the adjacency matrix given a set of molecules, X, and a particular distance metric.
+
+    Isotropic sklearn RBF kernels are dispatched to sklearn's rbf_kernel, which uses the BLAS based squared distance
+    expansion. Otherwise the metric is first called on the whole of X (the sklearn kernel syntax), then handed to
+    scipy's cdist (or pdist when symmetric) so that the pairwise loop runs in C, and only as a last resort evaluated
+    pair by pair in Python.
     
     Parameters 
     ----------
@@ -20,20 +68,70 @@ def adjacency(X,metric):
         
     metric : func
         A function that operates on two instances to compute their similiarty/distance
+
+    symmetric : bool, default=False
+        Whether the metric is symmetric, in which case only the upper triangle is computed with pdist and mirrored with
+        squareform, halving the number of metric evaluations. The diagonal is then filled with the self similarities
+        metric(x,x), which is zero for distances.
+
+    backend : str, default=None
+        Set to "numba" to evaluate the pairs with a parallel numba kernel. The metric must then either be decorated
+        with numba.njit or be the name of one of the bundled jitted metrics ("euclidean", "rbf" or "tanimoto"), and is
+        assumed to be symmetric.
+
+    radial : bool, default=False
+        Whether the metric is a function of the squared euclidean distance alone, phi(||x-y||^2). If so the squared
+        distances are computed with a single matrix product and the metric is applied to them elementwise.
+
+    n_jobs : int, default=None
+        If provided, callable metrics that cannot be called on the whole of X are evaluated pair by pair over n_jobs joblib workers
+        (-1 uses all cores) rather than with scipy. Worthwhile for expensive Python metrics such as graph edit distances
+        or RDKit similarities.
     """
     if not isinstance(X,np.ndarray):
         try: X = np.array(X)
         except Exception as e:
             return e
+    if backend == "numba":
+        from . import _numba_adj
+        if isinstance(metric,str):
+            if metric not in _numba_adj.metrics:
+                raise ValueError(f"Unknown numba metric {metric}, must be one of {sorted(_numba_adj.metrics)} or a numba.njit function.")
+            metric = _numba_adj.metrics[metric]
+        return _numba_adj.pairwise(X,metric)
+    elif backend is not None:
+        raise ValueError(f"Unknown backend {backend}, must be one of None or 'numba'.")
+    if RBF is not None and type(metric) is RBF and np.ndim(metric.length_scale) == 0: # Matern subclasses RBF
+        return rbf_kernel(X,X,gamma=1/(2*metric.length_scale**2))
+    if radial:
+        return metric(_squared_distances(X))
+    try:
+        adj = np.asarray(metric(X,X))
+        if adj.shape == (len(X),len(X)):
+            return adj
+    except Exception:
+        pass
+    if n_jobs is not None and callable(metric): # Named scipy metrics are already evaluated in C by cdist/pdist
+        return _parallel_pairwise(X,metric,n_jobs,symmetric)
     try:
-        adj = metric(X,X)
-        return adj
-    except:
+        if symmetric:
+            adj = squareform(pdist(X,metric=metric))
+            if callable(metric): # scipy's named metrics are distances, so only callables can have a non-zero diagonal
+                np.fill_diagonal(adj,[metric(x,x) for x in X])
+            return adj
+        return cdist(X,X,metric=metric)
+    except Exception:
+        if symmetric:
+            i, j = np.triu_indices(len(X))
+            adj = np.empty((len(X),len(X)))
+            adj[i,j] = [metric(X[a],X[b]) for a,b in zip(i,j)]
+            adj[j,i] = adj[i,j]
+            return adj
         return np.array([[metric(x,y) for y in X] for x in X])
 
 def degree(adjacency):
     """
-    Computes the degree matrix given an adjacency matrix.
+    Computes the degree matrix given an adjacency matrix. The degrees are the column sums, i.e. the in-degrees of a directed graph.
 
     Parameters
     ----------
@@ -44,13 +142,12 @@ def degree(adjacency):
         try: adjacency = np.array(adjacency)
         except Exception as e:
             return e
-    degree = np.zeros_like(adjacency)
-    np.fill_diagonal(degree, np.sum(adjacency,axis=0))
-    return degree
+    return np.diag(adjacency.sum(axis=0))
 
 def laplacian(adjacency):
     """
-    Computes the Laplacian from a given adjacency matrix 
+    Computes the Laplacian from a given adjacency matrix. The degree matrix is never materialised, the degrees are
+    written straight onto the diagonal of -A.
 
     Parameters
     ---------- 
@@ -61,4 +158,6 @@ def laplacian(adjacency):
         try: adjacency = np.array(adjacency)
         except Exception as e:
             return e
-    return degree(adjacency) - adjacency 
+    L = np.negative(adjacency)
+    L.flat[::adjacency.shape[0]+1] = adjacency.sum(axis=0) - adjacency.diagonal() # Write D - A onto the diagonal without building D.
+    return L
@@ -1,4 +1,7 @@
 import os
+import hashlib
+import inspect
+from collections import OrderedDict
 import matplotlib as mpl
 import matplotlib.pyplot as plt
 import numpy as np
@@ -6,9 +9,24 @@ from chemsp.utils import gini
 import networkx as nx 
 
 from matplotlib.offsetbox import AnchoredText
+from matplotlib.collections import LineCollection, PathCollection
 
+_LAYOUT_CACHE_SIZE = 16
+_layout_cache = OrderedDict()
 
-def signal_plot(coeffs,ylim=(-5,5),linewidth=1,gini=gini,ax=None,sort=False,spines=None,*args, **kwargs):
+# Canonical keywords accepted by ax.scatter, either as arguments or as PathCollection properties, less those plot_adj sets itself.
+# Aliases such as lw and ec are normalised to these before checking.
+_SCATTER_KWARGS = ((set(inspect.signature(mpl.axes.Axes.scatter).parameters) - {"self","x","y","kwargs"})
+                   | set(mpl.artist.ArtistInspector(PathCollection).get_setters())) - {"s","c","zorder"}
+
+_ensured_dirs = set()
+_SAVE_KWARGS = {".png" : dict(dpi=300,transparent=True),
+                ""     : dict(dpi=300,transparent=True),
+                ".pdf" : dict(),
+                ".svg" : dict(transparent=True)}
+
+
+def signal_plot(coeffs,ylim=(-5,5),linewidth=1,gini=gini,ax=None,sort=False,spines=None,**kwargs):
     """
     Plot a signal plot for the unsorted, signed coefficients of the Fourier expansion. 
     
@@ -22,6 +40,10 @@ def signal_plot(coeffs,ylim=(-5,5),linewidth=1,gini=gini,ax=None,sort=False,spin
         
     gini : func, default=gini
         A function to compute the gini coefficient of the spectra 
+
+    **kwargs
+        Passed to the matplotlib.collections.LineCollection that draws the coefficients, so they must be LineCollection
+        properties (e.g. alpha, linestyles) rather than ax.plot keywords such as marker.
         
     Returns 
     -------
@@ -32,9 +54,14 @@ def signal_plot(coeffs,ylim=(-5,5),linewidth=1,gini=gini,ax=None,sort=False,spin
         fig, ax = plt.subplots(figsize=(8,6))
     ax.set_ylim(*ylim)
     if sort:
-        coeffs = np.sort(np.abs(coeffs))
-    for x,coeff in enumerate(coeffs):
-        ax.plot((x,x),(0,coeff),linewidth=linewidth,c='k',*args, **kwargs)
+        coeffs = np.abs(coeffs) # Sort the single abs buffer in place, gini then skips its own sort.
+        coeffs.sort()
+    # Draw every coefficient as a single collection of (x,0) -> (x,coeff) segments rather than one artist each.
+    N = len(coeffs)
+    x = np.arange(N)
+    segs = np.stack([np.stack([x,np.zeros(N)],1), np.stack([x,coeffs],1)],1)
+    ax.add_collection(LineCollection(segs,linewidths=linewidth,colors='k',**kwargs))
+    ax.set_xlim(0,N)
     if gini is not None:
         ax.annotate(f"Gini Coefficient: {gini(coeffs):.4f}",xy=(0.1,ylim[1]-(ylim[1]/10)))
         
@@ -65,34 +92,41 @@ def spectrum_plot(coeffs,ylim=(-5,5),gini=gini,ax=None,*args,**kwargs):
     if ax is None:
         fig, ax = plt.subplots(figsize=(16,6))
     for name,coeff in coeffs.items():
-        coeff = np.sort(np.abs(np.array(coeff)))
+        coeff = np.array(coeff,dtype=float)
+        np.abs(coeff,out=coeff)
+        coeff.sort()
         ax.plot(np.arange(len(coeff)), coeff,label=f"{name} ({gini(coeff):.4f})")
     ax.set_xlim(0,len(coeff))
     return ax
 
 def plot_adj(adj,
-             node_cmap=matplotlib.cm.get_cmap('Spectral'),
-             edge_cmap=matplotlib.cm.get_cmap("Greys"),
+             node_cmap=mpl.colormaps['Spectral'],
+             edge_cmap=mpl.colormaps["Greys"],
              pos=nx.spring_layout,
              title=None,
              ax=None,
              signal=None,
              border_edge_cmap=None,
              return_pos=False,
-             *args,
+             cache_pos=False,
+             node_size=300,
+             width=1.0,
+             with_labels=False,
+             labels=None,
              **kwargs):
     """
-    Produce a visualisation of a matrix using networkx.draw. 
+    Produce a visualisation of a matrix as a graph. The nodes are drawn with a single scatter and the edges with a single
+    LineCollection, so the number of matplotlib artists does not grow with the size of the graph.
     
     Parameters
     ----------
     adj : np.array(N,N)
         The adjacency matrix to be visualised.
         
-    node_cmap : matplotlib.cm, default=matplotlib.cm.get_cmap("Spectral")
+    node_cmap : matplotlib.cm, default=matplotlib.colormaps["Spectral"]
         The node colourmap used to colour the nodes.
     
-    edge_cmap : matplotlib.cm, default=matplotlib.cm.get_cmap("Greys")
+    edge_cmap : matplotlib.cm, default=matplotlib.colormaps["Greys"]
         The colormap used to colour edge weights.
     
     pos : func or dict, default=nx.spring_layout
@@ -115,19 +149,63 @@ def plot_adj(adj,
         
     return_pos : bool, default=False
         Whether or not to return the positions dictionary.
+
+    cache_pos : bool, default=False
+        Whether to cache the layout computed by a callable pos, keyed on the adjacency matrix and the layout function, so that
+        plotting a sequence of signals on the same graph only computes the layout once.
+
+    node_size : float, default=300
+        The marker size of the nodes.
+
+    width : float, default=1.0
+        The line width of the edges.
+
+    with_labels : bool, default=False
+        Whether to label the nodes, drawn with nx.draw_networkx_labels. Keyword arguments starting with font_ (e.g. font_size)
+        are passed on to it.
+
+    labels : dict, default=None
+        A dictionary of node labels, implies with_labels. Defaults to the node indices.
+
+    **kwargs
+        Passed to the ax.scatter that draws the nodes, including aliases such as lw and ec. node_shape is accepted as an alias of
+        marker, and an edgecolor overrides border_edge_cmap. Unlike nx.draw, anything that is not a scatter keyword raises a TypeError.
         
     Returns 
     -------
     ax : matplotlib.Axes 
         Returns an axis object with the graph plot.
     """
-    G = nx.from_numpy_array(adj)
+    label_kwargs = {key : kwargs.pop(key) for key in list(kwargs) if key.startswith("font_")}
+    if "node_shape" in kwargs:
+        kwargs["marker"] = kwargs.pop("node_shape")
+    kwargs = mpl.cbook.normalize_kwargs(kwargs,PathCollection)
+    unknown = set(kwargs) - _SCATTER_KWARGS
+    if unknown:
+        raise TypeError(f"plot_adj got unexpected keyword arguments {sorted(unknown)}, remaining keyword arguments are passed to ax.scatter.")
+
+    # Build the edge list from the nonzero upper triangle in numpy rather than letting networkx walk all N^2 entries.
+    iu, ju = np.triu_indices(adj.shape[0],1)
+    weights = adj[iu,ju]
+    mask = weights != 0
+    iu, ju, weights = iu[mask], ju[mask], weights[mask]
+    G = nx.Graph()
+    G.add_nodes_from(range(adj.shape[0]))
+    G.add_weighted_edges_from(zip(iu.tolist(),ju.tolist(),weights.tolist()))
     if ax is None:
         fig, ax = plt.subplots(figsize=(8,8))
-    edges,weights = zip(*nx.get_edge_attributes(G,'weight').items())
     
     if callable(pos):
-        pos = pos(G)
+        if cache_pos:
+            key = (hashlib.sha1(np.ascontiguousarray(adj).tobytes()).hexdigest(), adj.shape, pos)
+            if key not in _layout_cache:
+                _layout_cache[key] = pos(G)
+                if len(_layout_cache) > _LAYOUT_CACHE_SIZE:
+                    _layout_cache.popitem(last=False)
+            _layout_cache.move_to_end(key)
+            pos = {node : np.array(xy) for node, xy in _layout_cache[key].items()} # Copy so the caller cannot alter the cache
+        else:
+            pos = pos(G)
         
     edge_colors = edge_cmap(weights)
     edge_colors[:,3] = 1-edge_colors[:,0]
@@ -140,12 +218,21 @@ def plot_adj(adj,
         else:
             colors = node_cmap(signal)
         
-    if border_edge_cmap is not None:
+    if "edgecolor" in kwargs:
+        edgecolors = kwargs.pop("edgecolor")
+    elif border_edge_cmap is not None:
         edgecolors = border_edge_cmap
     else:
         edgecolors = "k"
     
-    nx.draw(G,node_color=colors,pos=pos,edgecolors=edgecolors,edge_color=edge_colors,ax=ax, *args, **kwargs)
+    pos_arr = np.array([pos[n] for n in G.nodes()])
+    edge_segs = np.stack([pos_arr[iu],pos_arr[ju]],1)
+    ax.add_collection(LineCollection(edge_segs,colors=edge_colors,linewidths=width,zorder=1))
+    ax.scatter(pos_arr[:,0],pos_arr[:,1],s=node_size,c=colors,edgecolors=edgecolors,zorder=2,**kwargs)
+    if with_labels or labels is not None:
+        nx.draw_networkx_labels(G,pos,labels=labels,ax=ax,**label_kwargs)
+    ax.autoscale_view()
+    ax.set_axis_off()
     
     if title is not None:
         ax.set_title(title,fontsize=24)
@@ -156,7 +243,7 @@ def plot_adj(adj,
         return ax
 
 
-def save(name,directory='/'.join(os.getcwd().split('/')[:-1]) + "/Images",sub_dir=None,*args, **kwargs):
+def save(name,directory=os.path.join(os.path.dirname(os.getcwd()),"Images"),sub_dir=None,*args, **kwargs):
     """
     Custom save function to save images just how I like them.
     
@@ -165,28 +252,21 @@ def save(name,directory='/'.join(os.getcwd().split('/')[:-1]) + "/Images",sub_di
     name : str 
         The filename used to save the file
         
-    directory : str, default='/'.join(os.getcwd().split('/')[:-1]) + "/Images"
+    directory : str, default=os.path.join(os.path.dirname(os.getcwd()),"Images")
         The directory to save the files into. Defaults to the Images subdirectory in the 
         directory above (assumes this is executed in a code subdirectory.)
         
     sub_dir : str, default=None
-        Places the images into a sub directory within images.
+        Places the images into a sub directory within images, which is created if it does not exist.
     """
     assert name.count('.') <= 1, "Names with multiple periods are poor practice and not supported."
     
     if sub_dir is not None:
-        if not os.path.exists('/'.join(os.getcwd().split('/')[:-1])+"/Images/" + f"{sub_dir}"):
-            os.mkdir('/'.join(os.getcwd().split('/')[:-1])+"/Images/" + f"{sub_dir}")
-    
-        fname = directory + "/" + f"{sub_dir}/" + name
-    else:
-        fname = directory + "/" + name 
-        
-    if name.split('.')[-1] == ".png" or name.count('.') == 0:
-        plt.savefig(fname,dpi=300,bbox_inches="tight",transparent=True, *args, **kwargs)
-    elif name.split('.')[-1] == ".pdf":
-        plt.savefig(fname,bbox_inches="tight",*args, **kwargs)
-    elif name.split('.')[-1] == '.svg':
-        plt.savefig(fname, bbox_inches='tight',transparent=True, *args, **kwargs)
-    else:
-        plt.savefig(fname,bbox_inches="tight",*args,**kwargs)
+        directory = os.path.join(directory,sub_dir)
+        if directory not in _ensured_dirs:
+            os.makedirs(directory,exist_ok=True)
+            _ensured_dirs.add(directory)
+
+    fname = os.path.join(directory,name)
+    save_kwargs = {**_SAVE_KWARGS.get(os.path.splitext(name)[1],{}), **kwargs}
+    plt.savefig(fname,bbox_inches="tight",*args,**save_kwargs)
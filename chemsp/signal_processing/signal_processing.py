@@ -5,16 +5,50 @@ Functions
 ========
 
 fourier_basis : Returns the fourier basis (with optional eigenvalues) for a matrix representation of a graph
+fourier_basis_batch : Returns the fourier bases of a stack of small graph shift operators, with a closed form solver for 3x3 matrices
 gft : Performs a graph Fourier transform on a signal using the eigenbasis (output of Fourier)
 fourier_decomposition : Bundles multiple steps together, performs the GFT on a signal from the raw representations, X, similarity measure, K, and signal, S.
+fourier_decomposition_batch : Performs the GFT on a matrix of signals over the same graph in a single matrix product.
+fourier_power_spectrum : Computes the squared GFT coefficients of a signal on only the top k Fourier modes of K(X,X).
+clear_basis_cache : Empties the cache of Fourier bases used by fourier_decomposition.
 """
 
+import hashlib
+from collections import OrderedDict
+
 import numpy as np
+from scipy.linalg import eigh
+from scipy.linalg.blas import get_blas_funcs
+from scipy.sparse.linalg import eigsh
 from chemsp.graphs import adjacency
 
-def fourier_basis(gso,return_vals=False):
+try:
+    from sklearn.gaussian_process.kernels import Kernel
+except ImportError:
+    Kernel = None
+
+_BASIS_CACHE_SIZE = 8
+_basis_cache = OrderedDict()
+
+def _eigh_device(gso, backend):
+    """
+    Computes the full eigendecomposition of gso on the GPU with either cupy or torch (cuSOLVER) and copies the result back to the host.
+    """
+    if backend == "cupy":
+        import cupy as cp
+        eigenvalues, eigenvectors = cp.linalg.eigh(cp.asarray(gso), UPLO="U")
+        return cp.asnumpy(eigenvalues), cp.asnumpy(eigenvectors)
+    elif backend == "torch":
+        import torch
+        if not torch.cuda.is_available():
+            raise RuntimeError("The torch backend requires a CUDA device, use backend=None to compute the basis on the CPU.")
+        eigenvalues, eigenvectors = torch.linalg.eigh(torch.as_tensor(gso, device="cuda"), UPLO="U")
+        return eigenvalues.cpu().numpy(), eigenvectors.cpu().numpy()
+    raise ValueError(f"Unknown backend {backend}, must be one of None, 'cupy' or 'torch'.")
+
+def fourier_basis(gso,return_vals=False,k=None,validate=False,backend=None,dtype=None,symmetrize=False):
     """
-    Computes and returns the fourier basis of a particular matrix. Assumes that the matrix is symmetric and uses np.eigh
+    Computes and returns the fourier basis of a particular matrix. Assumes that the matrix is symmetric and uses scipy's eigh.
     
     Parameters 
     ----------
@@ -24,21 +58,142 @@ def fourier_basis(gso,return_vals=False):
         
     return_vals : bool, default=False
         Whether or not to return the eigenvalues. Defaults to false as the point of this function is to compute the Fourier basis of a symmetric matrix.
+
+    k : int, default=None
+        If provided, only the k eigenvectors with the largest eigenvalues are computed using LAPACK's evr driver, which avoids
+        solving the full eigenproblem. Otherwise the full spectrum is computed with the evd driver.
+
+    validate : bool, default=False
+        Whether to check that the graph shift operator is symmetric. This is a full O(N^2) pass over the matrix and its
+        transpose, so it is off by default. Without it only the upper triangle of gso is read, so a non-symmetric matrix
+        silently produces the basis of the symmetric matrix defined by its upper triangle.
+
+    backend : str, default=None
+        Set to "cupy" or "torch" to perform the eigendecomposition on the GPU, which is typically much faster for graphs
+        with more than a few thousand nodes. The full spectrum is always computed on the device, with k only truncating the
+        result. The eigenvectors are returned as host numpy arrays.
+
+    dtype : np.dtype, default=None
+        If provided, gso is cast to this dtype before the eigendecomposition. np.float32 roughly halves the cost of the
+        decomposition and of every projection onto the basis, at the cost of eigenvectors accurate to ~1e-6. This is ample for
+        Gini coefficients and plots, but eigenvectors with nearly degenerate eigenvalues will be poorly resolved.
+
+    symmetrize : bool, default=False
+        Whether to replace gso by its symmetric part, (gso + gso.T)/2, before the eigendecomposition. This costs a single NxN
+        write and is the cheaper alternative to validate when symmetry cannot be guaranteed (e.g. from numerical noise).
         
     Returns
     -------
     eigenvectors : np.array (NxN)
-        Produces the eigenmatrix in which column i is the eigenvector corresponding to the ith eigenvector.
+        Produces the eigenmatrix in which column i is the eigenvector corresponding to the ith eigenvector. If k is provided
+        the matrix is (Nxk) and the eigenvalues are in ascending order.
     """
-    assert np.allclose(gso, gso.T), "The provided graph shift operator is not symmetric."
     assert gso.shape[0] == gso.shape[1], "The provided graph shift operator is not square."
-    eigenvalues, eigenvectors = np.linalg.eigh(arr)
+    if dtype is not None:
+        gso = gso.astype(dtype, copy=False)
+    if symmetrize:
+        gso = np.add(gso, gso.T, dtype=None if np.issubdtype(gso.dtype, np.inexact) else np.float64) # Integer operators are halved in float
+        gso *= 0.5
+    elif validate:
+        assert np.allclose(gso, gso.T), "The provided graph shift operator is not symmetric."
+    N = gso.shape[0]
+    if backend is not None:
+        eigenvalues, eigenvectors = _eigh_device(gso, backend)
+        if k is not None:
+            eigenvalues, eigenvectors = eigenvalues[N-k:], eigenvectors[:,N-k:]
+    elif k is not None:
+        eigenvalues, eigenvectors = eigh(gso, lower=False, subset_by_index=(N-k, N-1), driver="evr")
+    else:
+        eigenvalues, eigenvectors = eigh(gso, lower=False, driver="evd")
     if return_vals:
         return eigenvectors, eigenvalues
     else:
         return eigenvectors
     
-def gft(fourier_basis, signal):
+def _cross(u, v):
+    return np.stack([u[1]*v[2] - u[2]*v[1], u[2]*v[0] - u[0]*v[2], u[0]*v[1] - u[1]*v[0]])
+
+def _eigh_sym3(A):
+    """
+    Closed form eigendecomposition of a stack of symmetric 3x3 matrices, (B,3,3), vectorised over the batch. The eigenvalues
+    are the trigonometric (Cardano) roots of the characteristic polynomial and the eigenvectors of the extreme eigenvalues are
+    the cross products of the rows of A - lambda I, with the middle eigenvector completing the orthonormal triad. Matrices with
+    (nearly) repeated eigenvalues, for which the cross products are ill-conditioned, are handed to np.linalg.eigh. Like the rest
+    of the module only the upper triangle is read.
+    """
+    a00, a11, a22 = A[:,0,0], A[:,1,1], A[:,2,2]
+    a01, a02, a12 = A[:,0,1], A[:,0,2], A[:,1,2]
+    q = (a00 + a11 + a22) / 3
+    b00, b11, b22 = a00 - q, a11 - q, a22 - q
+    p = np.sqrt((b00**2 + b11**2 + b22**2 + 2 * (a01**2 + a02**2 + a12**2)) / 6)
+    det = b00 * (b11*b22 - a12**2) - a01 * (a01*b22 - a12*a02) + a02 * (a01*a12 - b11*a02)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        r = det / (2 * p**3)
+    phi = np.arccos(np.clip(np.nan_to_num(r), -1, 1)) / 3
+    largest = q + 2 * p * np.cos(phi)
+    smallest = q + 2 * p * np.cos(phi + 2 * np.pi / 3)
+    eigenvalues = np.stack([smallest, 3 * q - largest - smallest, largest], axis=1)
+
+    def null_vector(lam):
+        r0 = np.stack([a00 - lam, a01, a02])
+        r1 = np.stack([a01, a11 - lam, a12])
+        r2 = np.stack([a02, a12, a22 - lam])
+        candidates = np.stack([_cross(r0, r1), _cross(r0, r2), _cross(r1, r2)]) # (3 candidates, 3 components, B)
+        norms = np.sqrt(np.einsum("cib,cib->cb", candidates, candidates))
+        best = np.argmax(norms, axis=0)
+        idx = np.arange(len(A))
+        with np.errstate(divide="ignore", invalid="ignore"):
+            return candidates[best,:,idx] / norms[best,idx][:,None]
+
+    v_small, v_large = null_vector(smallest), null_vector(largest)
+    eigenvectors = np.stack([v_small, _cross(v_large.T, v_small.T).T, v_large], axis=2)
+
+    gap = np.minimum(eigenvalues[:,2] - eigenvalues[:,1], eigenvalues[:,1] - eigenvalues[:,0])
+    degenerate = ~(gap > 1e-6 * (np.abs(q) + p)) # Also catches the NaNs from scalar multiples of the identity
+    if degenerate.any():
+        eigenvalues[degenerate], eigenvectors[degenerate] = np.linalg.eigh(A[degenerate], UPLO="U")
+    return eigenvalues, eigenvectors
+
+def fourier_basis_batch(gsos, return_vals=False):
+    """
+    Computes the Fourier bases of a stack of small graph shift operators, e.g. the local neighbourhoods of many molecules, in
+    a single vectorised call rather than looping over fourier_basis. Stacks of 3x3 operators use a closed form solver, which is far
+    faster than LAPACK for matrices this small. Other sizes use numpy's batched eigh.
+
+    Parameters
+    ----------
+    gsos : np.array, (BxNxN)
+        A stack of B symmetric graph shift operators.
+
+    return_vals : bool, default=False
+        Whether or not to return the eigenvalues.
+
+    Returns
+    -------
+    eigenvectors : np.array (BxNxN)
+        The eigenmatrices, in which column i of each matrix is the eigenvector corresponding to the ith (ascending) eigenvalue.
+    """
+    gsos = np.asarray(gsos, dtype=float)
+    assert gsos.ndim == 3 and gsos.shape[1] == gsos.shape[2], "The graph shift operators must be a stack of square matrices."
+    if gsos.shape[1] == 3:
+        eigenvalues, eigenvectors = _eigh_sym3(gsos)
+    else:
+        eigenvalues, eigenvectors = np.linalg.eigh(gsos, UPLO="U")
+    if return_vals:
+        return eigenvectors, eigenvalues
+    else:
+        return eigenvectors
+
+def _gemm_t(A, B):
+    """
+    Computes A.T @ B with a single level 3 BLAS call, passing the transpose as a flag rather than copying A.
+    """
+    gemm = get_blas_funcs("gemm", (A, B))
+    if A.flags.f_contiguous: # The default layout out of eigh
+        return gemm(1.0, A, B, trans_a=1)
+    return gemm(1.0, A.T, B)
+
+def gft(fourier_basis, signal, block_size=None):
     """
     Performs the Graph Fourier Transform on a signal and returns the unsorted coefficient spectrum.
     
@@ -47,21 +202,92 @@ def gft(fourier_basis, signal):
     fourier_basis : np.array (NxN)
         The fourier basis of interest. Note that the columns must be the eigenvectors, not the rows. This is the default behaviour of numpy.eigh
         
-    signal : np.array (N,)
-        The signal to be projected onto the Fourier basis. Dimensions of the two must match
+    signal : np.array (N,) or (N,P)
+        The signal to be projected onto the Fourier basis. Dimensions of the two must match. A matrix of P signals stored as columns
+        is projected with a single BLAS gemm, which is much faster than P separate projections.
+
+    block_size : int, default=None
+        If provided with a matrix of signals, the projection is tiled over blocks of block_size eigenvectors so that each block of the basis
+        stays in cache while it is applied to every signal. A block size with block_size * N * 8 bytes fitting in L2 is a good choice for
+        large N. Otherwise the tiling is left to BLAS.
         
     Returns 
     -------
-    coefficients : np.array (N,)
+    coefficients : np.array (N,) or (N,P)
         The coefficient spectrum of the signal projected onto the Fourier basis.
     """
     assert fourier_basis.shape[0] == signal.shape[0], "The number of eigenvectors must equal the dimension of the signal."
-    
-    return fourier_basis.T @ signal # Compute the inner produce between the matrix of eigenvectors (Fourier basis) and the signal of interest.
+    if fourier_basis.dtype == np.float32: # Project in single precision rather than upcasting the basis
+        signal = signal.astype(np.float32, copy=False)
+    if signal.ndim == 2:
+        if block_size is None:
+            return _gemm_t(fourier_basis, signal)
+        fourier_basis = np.asfortranarray(fourier_basis) # Makes each block of eigenvectors contiguous, a no-op out of eigh
+        coefficients = np.empty((fourier_basis.shape[1], signal.shape[1]), dtype=np.result_type(fourier_basis, signal))
+        for start in range(0, fourier_basis.shape[1], block_size):
+            block = slice(start, start + block_size)
+            coefficients[block] = _gemm_t(fourier_basis[:,block], signal)
+        return coefficients
 
-def fourier_decomposition(X, K, S):
+    # Compute the inner product between the matrix of eigenvectors (Fourier basis) and the signal of interest with a single BLAS call.
+    gemv = get_blas_funcs("gemv", (fourier_basis, signal))
+    if fourier_basis.flags.f_contiguous: # The default layout out of eigh
+        return gemv(1.0, fourier_basis, signal, trans=1)
+    return gemv(1.0, fourier_basis.T, signal)
+
+def _kernel_key(K):
+    """
+    Returns a hashable key that identifies K, or None if it cannot be identified reliably. Named scipy metrics are keyed on
+    their name and sklearn kernels on their type and full precision parameters (their repr rounds them). Arbitrary callables
+    can capture any state, and their ids are reused once they are garbage collected, so they cannot be keyed.
+    """
+    if isinstance(K, str):
+        return K
+    if Kernel is not None and isinstance(K, Kernel):
+        params = []
+        for name, value in sorted(K.get_params(deep=True).items()):
+            if isinstance(value, Kernel): # Nested kernels are keyed on their type, their parameters are also in the deep params
+                value = type(value).__qualname__
+            elif isinstance(value, np.ndarray):
+                value = (value.shape, value.tolist())
+            params.append((name, repr(value)))
+        return (type(K).__qualname__, tuple(params))
+    return None
+
+def _basis_for(X, K, backend=None, dtype=None, cache=True):
+    """
+    Returns the Fourier basis of K(X,X), caching the most recent results keyed on the bytes of X and the identity of K as the
+    adjacency and eigendecomposition do not depend on the signal. The cached matrices are read only. Nothing is cached when
+    K cannot be keyed (see _kernel_key) or X is an object array, whose bytes are the addresses of its elements.
+    """
+    X = np.asarray(X)
+    kernel_key = _kernel_key(K)
+    if not cache or kernel_key is None or X.dtype.hasobject:
+        return fourier_basis(adjacency(X, K), backend=backend, dtype=dtype)
+    key = (hashlib.sha1(np.ascontiguousarray(X).tobytes()).hexdigest(), X.shape, X.dtype.str, kernel_key, backend,
+           None if dtype is None else np.dtype(dtype).str)
+    if key in _basis_cache:
+        _basis_cache.move_to_end(key)
+        return _basis_cache[key]
+    eigenvectors = fourier_basis(adjacency(X, K), backend=backend, dtype=dtype)
+    eigenvectors.flags.writeable = False
+    _basis_cache[key] = eigenvectors
+    if len(_basis_cache) > _BASIS_CACHE_SIZE:
+        _basis_cache.popitem(last=False)
+    return eigenvectors
+
+def clear_basis_cache():
+    """
+    Empties the cache of Fourier bases used by fourier_decomposition and fourier_decomposition_batch, releasing their memory.
+    Each cached basis of an N node graph holds N^2 floats, i.e. 800MB in double precision at N=1e4.
+    """
+    _basis_cache.clear()
+
+def fourier_decomposition(X, K, S, backend=None, dtype=None, cache=True):
     """
     Computes the complete Fourier projection for a given set of representations (X), similarity measure (K), and a signal (S) defined over the graph.
+    The Fourier basis is cached on (X, K), so repeated calls with new signals on the same graph only cost the projection. Only named
+    scipy metrics and sklearn kernels are cached, as arbitrary callables cannot be reliably identified.
     
     Parameters
     ----------
@@ -74,12 +300,89 @@ def fourier_decomposition(X, K, S):
         
     S : np.array(N,)
         A N dimensional signal that is going to projected onto the orthonormal eigenbasis of K(X,X)
+
+    backend : str, default=None
+        The backend used to compute the Fourier basis, see fourier_basis.
+
+    dtype : np.dtype, default=None
+        The dtype the Fourier basis is computed in, see fourier_basis.
+
+    cache : bool, default=True
+        Whether to look up and store the Fourier basis in the basis cache. See clear_basis_cache to release its memory.
     
     Returns
     -------
     coeffs : np.array(N,)
         A numpy array of coefficients corresponding to the linear combination of eigenvectors required to reconstruct the signal.
     """
+    return gft(_basis_for(X, K, backend=backend, dtype=dtype, cache=cache),S)
+
+def fourier_decomposition_batch(X, K, S, backend=None, block_size=None, dtype=None, cache=True):
+    """
+    Computes the Fourier projection of P signals defined over the same graph in a single matrix product. See fourier_decomposition.
+
+    Parameters
+    ----------
+    X : np.array(NxM)
+        An array containing N molecules with their associated M dimensional representation
+
+    K : func
+        A similarity/kernel function that acts on X, see fourier_decomposition.
+
+    S : np.array(N,P)
+        A matrix whose P columns are the N dimensional signals to be projected onto the orthonormal eigenbasis of K(X,X)
+
+    backend : str, default=None
+        The backend used to compute the Fourier basis, see fourier_basis.
+
+    dtype : np.dtype, default=None
+        The dtype the Fourier basis is computed in, see fourier_basis.
+
+    cache : bool, default=True
+        Whether to look up and store the Fourier basis in the basis cache. See clear_basis_cache to release its memory.
+
+    block_size : int, default=None
+        The number of eigenvectors projected at a time, see gft.
+
+    Returns
+    -------
+    coeffs : np.array(N,P)
+        The coefficients of each signal, stored as columns.
+    """
+    return gft(_basis_for(X, K, backend=backend, dtype=dtype, cache=cache),np.asarray(S).reshape(len(X),-1),block_size=block_size)
+
+def fourier_power_spectrum(X, K, S, k=6, return_vals=False):
+    """
+    Computes the power, (Q.T @ S)**2, of a signal (S) on the k Fourier modes of K(X,X) with the largest eigenvalues, without
+    computing the full eigenbasis. The Ritz vectors are found with Lanczos iteration (scipy's eigsh) started from the signal itself.
+    Useful when the signs of the coefficients are irrelevant, such as for Gini coefficients and sorted spectrum plots.
+
+    Parameters
+    ----------
+    X : np.array(NxM)
+        An array containing N molecules with their associated M dimensional representation
+
+    K : func
+        A similarity/kernel function that acts on X, see fourier_decomposition.
+
+    S : np.array(N,)
+        A N dimensional signal that is going to projected onto the top k eigenvectors of K(X,X)
+
+    k : int, default=6
+        The number of eigenvectors to compute. Must be smaller than N.
+
+    return_vals : bool, default=False
+        Whether or not to also return the corresponding eigenvalues.
+
+    Returns
+    -------
+    power : np.array(k,)
+        The squared coefficients of the signal on the top k eigenvectors, ordered by ascending eigenvalue.
+    """
     adj = adjacency(X, K)
-    eigenvectors = fourier_basis(adj)
-    return gft(eigenvectors,S)
+    eigenvalues, eigenvectors = eigsh(adj, k=k, which="LA", v0=S if np.any(S) else None) # ARPACK rejects a zero starting vector
+    power = gft(eigenvectors, S)**2
+    if return_vals:
+        return power, eigenvalues
+    else:
+        return power
@@ -14,12 +14,13 @@ def gini(array):
     """
     # based on bottom eq: http://www.statsdirect.com/help/content/image/stat0206_wmf.gif
     # from: http://www.statsdirect.com/help/default.htm#nonparametric_methods/gini.htm
-    array = array.flatten() #all values are treated equally, arrays must be 1d
+    array = np.asarray(array,dtype=np.float64).flatten() #all values are treated equally, arrays must be 1d. Summed in double precision.
     if np.amin(array) < 0:
         #array -= np.amin(array) #values cannot be negative
         array = np.abs(array)
     array += 0.0000001 #values cannot be 0
-    array = np.sort(array) #values must be sorted
+    if np.any(array[1:] < array[:-1]): #values must be sorted, skipped in O(N) if they already are
+        array = np.sort(array)
     index = np.arange(1,array.shape[0]+1) #index per array element
     n = array.shape[0]#number of array elements
     return ((np.sum((2 * index - n  - 1) * array)) / (n * np.sum(array))) #Gini coefficient
@@ -1,12 +1,41 @@
+import os
+import tempfile
 import unittest
 import numpy as np
 import pandas as pd
-from sklearn.gaussian_process.kernels import RBF
+import networkx as nx
+from sklearn.gaussian_process.kernels import RBF, Matern
 
 from chemsp.graphs import *
+from chemsp.signal_processing import *
+from chemsp.utils import gini
 
 import matplotlib
+matplotlib.use("Agg")
 import matplotlib.pyplot as plt
+from matplotlib.collections import LineCollection, PathCollection
+
+from chemsp.plotting.plotting import *
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
+try:
+    import joblib
+except ImportError:
+    joblib = None
+
+try:
+    import cupy
+except ImportError:
+    cupy = None
+
+try:
+    import torch
+except ImportError:
+    torch = None
 
 
 X = np.array([[0.1,0.1,0.1],
@@ -18,13 +47,246 @@ class TestAdjacency(unittest.TestCase):
         adj = adjacency(X,RBF(1))
         assert adj is not None, "Adjacency not successfully generated."
 
+    def test_matern_adj(self):
+        assert np.allclose(adjacency(X,Matern()), Matern()(X)), "Matern kernel was treated as an RBF kernel."
+        assert np.allclose(adjacency(X,Matern(nu=0.5)), Matern(nu=0.5)(X)), "Matern kernel was treated as an RBF kernel."
+
+    def test_pairwise_adj(self):
+        dist = lambda x,y: np.sqrt(np.sum((x-y)**2))
+        adj = adjacency(X,dist)
+        assert adj.shape == (3,3), "Pairwise adjacency has the wrong shape."
+        assert np.allclose(adj, adjacency(X,dist,symmetric=True)), "Symmetric adjacency does not match the full computation."
+
+    def test_symmetric_similarity_adj(self):
+        kernel = lambda x,y: np.exp(-np.sum((x-y)**2)/2)
+        adj = adjacency(X,kernel,symmetric=True)
+        assert np.allclose(adj, RBF(1)(X)), "Symmetric adjacency does not recover the self similarities."
+
+    def test_radial_adj(self):
+        adj = adjacency(X,lambda D: np.exp(-D/2),radial=True)
+        assert np.allclose(adj, RBF(1)(X)), "Radial adjacency does not match the sklearn kernel."
+
+    def test_unknown_backend_adj(self):
+        with self.assertRaises(ValueError):
+            adjacency(X,RBF(1),backend="numpy")
+
+    @unittest.skipIf(numba is None, "numba is not installed.")
+    def test_numba_adj(self):
+        adj = adjacency(X,"rbf",backend="numba")
+        assert np.allclose(adj, adjacency(X,RBF(1))), "Numba adjacency does not match the sklearn kernel."
+        assert np.allclose(adjacency(X,"euclidean",backend="numba"), adjacency(X,"euclidean")), "Numba euclidean does not match scipy."
+
+    @unittest.skipIf(numba is None, "numba is not installed.")
+    def test_numba_adj_user_metric(self):
+        @numba.njit
+        def manhattan(x,y):
+            return np.sum(np.abs(x-y))
+        assert np.allclose(adjacency(X,manhattan,backend="numba"), adjacency(X,"cityblock")), "Numba adjacency with a user metric is incorrect."
+
+    @unittest.skipIf(numba is None, "numba is not installed.")
+    def test_numba_adj_unknown_metric(self):
+        with self.assertRaises(ValueError):
+            adjacency(X,"cosine",backend="numba")
+
+    @unittest.skipIf(joblib is None, "joblib is not installed.")
+    def test_parallel_adj(self):
+        kernel = lambda x,y: np.exp(-np.sum((x-y)**2)/2)
+        adj = adjacency(X,kernel,symmetric=True,n_jobs=2)
+        assert np.allclose(adj, RBF(1)(X)), "Parallel adjacency does not match the sklearn kernel."
+        assert np.allclose(adjacency(X,"euclidean",n_jobs=2), adjacency(X,"euclidean")), "Named metrics should ignore n_jobs."
+
 class TestDegree(unittest.TestCase):
     def test_degree(self):
         deg = degree(adjacency(X, RBF(1)))
 
+    def test_degree_asymmetric(self):
+        deg = degree([[0,1],[2,0]])
+        assert np.allclose(deg, np.diag([2,1])), "Degrees should be the column sums of the adjacency."
+
 class TestLaplacian(unittest.TestCase):
     def test_laplacian(self):
         lap = laplacian(adjacency(X,RBF(1)))
+        assert np.allclose(lap, degree(adjacency(X,RBF(1))) - adjacency(X,RBF(1))), "Laplacian does not equal D - A."
+
+    def test_laplacian_asymmetric(self):
+        A = np.array([[0.,1.],[2.,0.]])
+        assert np.allclose(laplacian(A), degree(A) - A), "Laplacian of an asymmetric adjacency does not equal D - A."
+
+class TestFourier(unittest.TestCase):
+    def test_fourier_basis(self):
+        Q, vals = fourier_basis(adjacency(X,RBF(1)),return_vals=True)
+        assert np.allclose(Q.T @ Q, np.eye(3)), "Fourier basis is not orthonormal."
+        Qk, vals_k = fourier_basis(adjacency(X,RBF(1)),return_vals=True,k=2)
+        assert Qk.shape == (3,2), "Truncated Fourier basis has the wrong shape."
+        assert np.allclose(vals[-2:], vals_k), "Truncated spectrum does not match the largest eigenvalues."
+
+    def test_fourier_basis_unknown_backend(self):
+        with self.assertRaises(ValueError):
+            fourier_basis(adjacency(X,RBF(1)),backend="numpy")
+
+    @unittest.skipIf(cupy is None, "cupy is not installed.")
+    def test_fourier_basis_cupy(self):
+        _, vals = fourier_basis(adjacency(X,RBF(1)),return_vals=True,backend="cupy")
+        assert np.allclose(vals, np.linalg.eigvalsh(adjacency(X,RBF(1)))), "cupy spectrum is incorrect."
+
+    @unittest.skipIf(torch is None, "torch is not installed.")
+    def test_fourier_basis_torch(self):
+        if not torch.cuda.is_available():
+            with self.assertRaises(RuntimeError):
+                fourier_basis(adjacency(X,RBF(1)),backend="torch")
+        else:
+            _, vals = fourier_basis(adjacency(X,RBF(1)),return_vals=True,backend="torch")
+            assert np.allclose(vals, np.linalg.eigvalsh(adjacency(X,RBF(1)))), "torch spectrum is incorrect."
+
+    def test_fourier_basis_validate(self):
+        with self.assertRaises(AssertionError):
+            fourier_basis(np.triu(adjacency(X,RBF(1))),validate=True)
+
+    def test_fourier_basis_symmetrize(self):
+        A = adjacency(X,RBF(1))
+        noisy = A + np.triu(np.full((3,3),1e-3),1)
+        _, vals = fourier_basis(noisy,return_vals=True,symmetrize=True)
+        assert np.allclose(vals, np.linalg.eigvalsh((noisy + noisy.T)/2)), "Symmetrized spectrum is incorrect."
+
+    def test_fourier_basis_symmetrize_int(self):
+        A = np.array([[0,1,0],[1,0,1],[0,1,0]])
+        _, vals = fourier_basis(laplacian(A),return_vals=True,symmetrize=True)
+        assert np.allclose(vals, np.linalg.eigvalsh(laplacian(A))), "Symmetrized spectrum of an integer operator is incorrect."
+
+    def test_fourier_basis_float32(self):
+        Q = fourier_basis(adjacency(X,RBF(1)),dtype=np.float32)
+        assert Q.dtype == np.float32, "Fourier basis was not computed in single precision."
+        assert gft(Q,np.array([1.,2.,3.])).dtype == np.float32, "GFT upcast the single precision basis."
+
+    def test_fourier_basis_batch(self):
+        gsos = np.stack([adjacency(X,RBF(1)), np.diag([1.,1.,2.]), laplacian(adjacency(X,RBF(1)))])
+        Q, vals = fourier_basis_batch(gsos,return_vals=True)
+        assert np.allclose(vals, np.linalg.eigvalsh(gsos)), "Batched eigenvalues are incorrect."
+        assert np.allclose(gsos @ Q, Q * vals[:,None,:]), "Batched eigenvectors are incorrect."
+
+    def test_fourier_basis_batch_general(self):
+        gsos = np.stack([laplacian(np.ones((4,4))), np.diag([1.,2.,3.,4.]) + np.ones((4,4))])
+        Q, vals = fourier_basis_batch(gsos,return_vals=True)
+        assert np.allclose(vals, np.linalg.eigvalsh(gsos)), "Batched 4x4 eigenvalues are incorrect."
+        assert np.allclose(gsos @ Q, Q * vals[:,None,:]), "Batched 4x4 eigenvectors are incorrect."
+
+    def test_fourier_basis_batch_upper(self):
+        gsos = np.stack([np.diag([1.,1.,2.]), np.diag([1.,2.,3.])]) + np.tril(np.full((3,3),0.1),-1)
+        _, vals = fourier_basis_batch(gsos,return_vals=True)
+        assert np.allclose(vals, np.linalg.eigvalsh(gsos,UPLO="U")), "Batched eigendecomposition did not read the upper triangle."
+
+    def test_gft_blocked(self):
+        Q = fourier_basis(adjacency(X,RBF(1)))
+        S = np.array([[1.,2.,3.],[0.,1.,0.]]).T
+        assert np.allclose(gft(Q,S,block_size=2), Q.T @ S), "Blocked GFT does not match the direct projection."
+
+    def test_fourier_decomposition(self):
+        S = np.array([1.,2.,3.])
+        coeffs = fourier_decomposition(X,RBF(1),S)
+        assert np.allclose(fourier_basis(adjacency(X,RBF(1))) @ coeffs, S), "Signal not reconstructed from its coefficients."
+
+    def test_fourier_decomposition_batch(self):
+        S = np.array([[1.,2.,3.],[0.,1.,0.]]).T
+        coeffs = fourier_decomposition_batch(X,RBF(1),S)
+        assert np.allclose(coeffs[:,1], fourier_decomposition(X,RBF(1),S[:,1])), "Batched decomposition does not match the single signal case."
+
+    def test_fourier_power_spectrum_zero_signal(self):
+        power, vals = fourier_power_spectrum(X,RBF(1),np.zeros(3),k=1,return_vals=True)
+        assert np.allclose(power, 0), "A zero signal should have no power."
+        assert np.allclose(vals, np.linalg.eigvalsh(adjacency(X,RBF(1)))[-1:]), "Eigenvalues are incorrect for a zero signal."
+
+    def test_basis_cache_kernel_key(self):
+        S = np.array([1.,2.,3.])
+        assert repr(RBF(1.0)) == repr(RBF(1.004)), "Kernels should print the same for this test to be meaningful."
+        coeffs = fourier_decomposition(X,RBF(1.0),S)
+        coeffs_uncached = fourier_decomposition(X,RBF(1.004),S,cache=False)
+        assert np.allclose(fourier_decomposition(X,RBF(1.004),S), coeffs_uncached), "Cache returned the basis of a different kernel."
+        assert not np.allclose(coeffs, coeffs_uncached), "Kernels should give different coefficients."
+        clear_basis_cache()
+
+    def test_fourier_power_spectrum(self):
+        S = np.array([1.,2.,3.])
+        power = fourier_power_spectrum(X,RBF(1),S,k=1)
+        assert np.allclose(power, fourier_decomposition(X,RBF(1),S)[-1:]**2), "Power spectrum does not match the full decomposition."
+
+class TestGini(unittest.TestCase):
+    def test_gini_sorted(self):
+        coeffs = np.array([0.5,-3.,0.1,2.])
+        assert np.isclose(gini(coeffs), gini(np.sort(np.abs(coeffs)))), "Gini coefficient depends on the input ordering."
+
+class TestPlotting(unittest.TestCase):
+    def tearDown(self):
+        plt.close("all")
+
+    def test_signal_plot(self):
+        coeffs = np.array([0.5,-3.,0.1,2.])
+        ax = signal_plot(coeffs,alpha=0.5)
+        collections = [c for c in ax.collections if isinstance(c,LineCollection)]
+        assert len(collections) == 1, "Signal plot should draw a single LineCollection."
+        segs = collections[0].get_segments()
+        assert len(segs) == 4, "Signal plot should draw one segment per coefficient."
+        assert np.allclose([seg[1,1] for seg in segs], coeffs), "Segments do not end at the coefficients."
+
+    def test_signal_plot_sorted(self):
+        ax = signal_plot(np.array([0.5,-3.,0.1,2.]),sort=True)
+        segs = ax.collections[0].get_segments()
+        assert np.allclose([seg[1,1] for seg in segs], [0.1,0.5,2.,3.]), "Sorted signal plot is not sorted by magnitude."
+
+    def test_spectrum_plot(self):
+        ax = spectrum_plot({"a" : np.array([0.5,-3.,0.1]), "b" : [1.,-2.,0.]})
+        assert len(ax.lines) == 2, "Spectrum plot should draw one line per spectrum."
+        assert np.allclose(ax.lines[0].get_ydata(), [0.1,0.5,3.]), "Spectrum is not the sorted magnitudes."
+
+    def test_plot_adj_edges(self):
+        A = np.array([[1.,0.5,0.],
+                      [0.5,1.,0.2],
+                      [0.,0.2,1.]])
+        ax, pos = plot_adj(A,return_pos=True)
+        edges = [c for c in ax.collections if isinstance(c,LineCollection)][0].get_segments()
+        expected = [np.array([pos[0],pos[1]]), np.array([pos[1],pos[2]])]
+        assert len(edges) == 2, "Only the nonzero off diagonal entries should be drawn as edges."
+        assert all(np.allclose(edge,exp) for edge,exp in zip(edges,expected)), "Edges do not join the right nodes."
+
+    def test_plot_adj_no_edges(self):
+        ax = plot_adj(np.zeros((4,4)))
+        edges = [c for c in ax.collections if isinstance(c,LineCollection)][0]
+        assert len(edges.get_segments()) == 0, "An all zero adjacency should have no edges."
+
+    def test_plot_adj_kwargs(self):
+        A = adjacency(X,RBF(1))
+        ax = plot_adj(A,with_labels=True,width=2,font_size=8,alpha=0.5)
+        edges = [c for c in ax.collections if isinstance(c,LineCollection)][0]
+        assert len(ax.texts) == 3, "Node labels were not drawn."
+        assert np.allclose(edges.get_linewidths(), 2), "Edge width was not applied."
+        with self.assertRaises(TypeError):
+            plot_adj(A,arrows=True)
+
+    def test_plot_adj_scatter_aliases(self):
+        A = adjacency(X,RBF(1))
+        ax = plot_adj(A,lw=2,ec="r",node_shape="s")
+        nodes = [c for c in ax.collections if isinstance(c,PathCollection)][0]
+        assert np.allclose(nodes.get_linewidths(), 2), "lw alias was not applied to the nodes."
+        assert np.allclose(nodes.get_edgecolors(), matplotlib.colors.to_rgba("r")), "ec alias was not applied to the nodes."
+
+    def test_plot_adj_cache_pos(self):
+        A = adjacency(X,RBF(1))
+        _, pos = plot_adj(A,return_pos=True,cache_pos=True)
+        _, cached = plot_adj(A,pos=nx.spring_layout,return_pos=True,cache_pos=True)
+        assert all(np.allclose(pos[n],cached[n]) for n in pos), "Cached layout was not reused." # spring_layout is randomly seeded
+        cached[0][:] = 100
+        _, again = plot_adj(A,return_pos=True,cache_pos=True)
+        assert np.allclose(again[0], pos[0]), "Modifying the returned positions altered the cache."
+
+    def test_save(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            plt.figure(figsize=(1,1))
+            plt.plot([0,1])
+            save("default.png",directory=tmp,sub_dir="s")
+            save("low.png",directory=tmp,sub_dir="s",dpi=50)
+            assert os.path.isdir(os.path.join(tmp,"s")), "Sub directory was not created."
+            default = plt.imread(os.path.join(tmp,"s","default.png"))
+            low = plt.imread(os.path.join(tmp,"s","low.png"))
+            assert default.shape[0] > 4 * low.shape[0], "Caller dpi did not override the default of 300."
 
 if __name__ == "__main__":
     unittest.main()